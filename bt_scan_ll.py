@@ -2,15 +2,172 @@
 # Working Bluetooth Scanner for ESP32-C6 using low-level bluetooth module
 # This bypasses aioble and uses the core bluetooth module directly
 
+import array
 import asyncio
+import binascii
 import bluetooth
+import micropython
+import select
 from machine import Pin
+from micropython import const
+import sys
 import time
-import struct
+
+_IRQ_SCAN_RESULT = const(5)
+_IRQ_SCAN_DONE = const(6)
+
+# _ad_ofs layout, filled in by _parse_ad:
+#   (start, length) of the first name and first manufacturer structure,
+#   then a count and (AD type, start, length) for every UUID list
+#   (0x02/0x03 16-bit, 0x06/0x07 128-bit) in advertisement order
+_AD_NAME = const(0)  # 0x08/0x09 Shortened/Complete Local Name
+_AD_MFG = const(1)  # 0xFF Manufacturer Specific Data
+_AD_UUIDS = const(4)  # index of the UUID list count
+_AD_MAX_UUID_LISTS = const(9)  # a UUID list takes >= 4 of the 31 bytes
+_ad_ofs = bytearray(_AD_UUIDS + 1 + 3 * _AD_MAX_UUID_LISTS)
+
+_MAX_DEVICES = const(256)
+_ADV_SLOTS = const(32)  # ring size, must be a power of two
+_ADV_MAX = const(31)  # legacy advertising payload limit
+
+# Signal strength labels for RSSI > -50, -60, -70, -80 dBm and below
+_STRENGTH_TABLE = ("Excellent", "Good", "Fair", "Weak", "Very Weak")
+
+@micropython.viper
+def _parse_ad(buf: ptr8, blen: int) -> int:
+    """Single pass over the AD structures in buf.
+
+    Stores the payload offset/length of the first name and manufacturer
+    structures, and of every UUID list, in _ad_ofs. Returns a bitmask
+    (1 << _AD_NAME, 1 << _AD_MFG) of which of the first two were found.
+    """
+    ofs = ptr8(_ad_ofs)
+    found = 0
+    nuuid = 0
+    i = 0
+    while i + 1 < blen:
+        length = buf[i]
+        if length == 0:
+            break
+        end = i + 1 + length
+        if end > blen:
+            end = blen
+        ad_type = buf[i + 1]
+        if ad_type == 0x09 or ad_type == 0x08:
+            slot = _AD_NAME
+        elif ad_type == 0xFF:
+            slot = _AD_MFG
+        else:
+            slot = -1
+        if slot >= 0:
+            if not (found & (1 << slot)):
+                found |= 1 << slot
+                ofs[2 * slot] = i + 2
+                ofs[2 * slot + 1] = end - (i + 2)
+        elif ad_type == 0x02 or ad_type == 0x03 or ad_type == 0x06 or ad_type == 0x07:
+            # Lists too short to hold a UUID are skipped
+            if end - (i + 2) >= 2 and nuuid < _AD_MAX_UUID_LISTS:
+                k = _AD_UUIDS + 1 + 3 * nuuid
+                ofs[k] = ad_type
+                ofs[k + 1] = i + 2
+                ofs[k + 2] = end - (i + 2)
+                nuuid += 1
+        i += 1 + length
+    ofs[_AD_UUIDS] = nuuid
+    return found
+
+@micropython.native
+def _parse_adv(adv_data, blen):
+    """Decode (name, services, manufacturer data) from the first blen bytes of adv_data"""
+    name = None
+    services = None  # Only allocated if the advert lists any
+    manufacturer_data = None
+    # _parse_ad clamps every (start, length) pair to blen, so the reads
+    # below stay in bounds without needing an exception handler
+    found = _parse_ad(adv_data, blen)
+    # Slicing the view doesn't copy; only data that is kept gets copied
+    mv = memoryview(adv_data)
+    if found & (1 << _AD_MFG):
+        start = _ad_ofs[2 * _AD_MFG]
+        manufacturer_data = bytes(mv[start:start + _ad_ofs[2 * _AD_MFG + 1]])
+    # Every UUID list in the advert, in the order it was broadcast
+    for k in range(_AD_UUIDS + 1, _AD_UUIDS + 1 + 3 * _ad_ofs[_AD_UUIDS], 3):
+        start = _ad_ofs[k + 1]
+        n = _ad_ofs[k + 2]
+        if _ad_ofs[k] <= 0x03:  # 16-bit UUIDs
+            if services is None:
+                services = []
+            # One or two UUIDs is by far the common case; skip the loop
+            if n == 2:
+                services.append(_uuid16_str(adv_data, start))
+            elif n == 4:
+                services.append(_uuid16_str(adv_data, start))
+                services.append(_uuid16_str(adv_data, start + 2))
+            else:
+                # Stop before a trailing odd byte
+                for j in range(start, start + n - 1, 2):
+                    services.append(_uuid16_str(adv_data, j))
+        elif n >= 16:  # 128-bit UUIDs
+            if services is None:
+                services = []
+            # Stop before a truncated trailing UUID
+            for j in range(start, start + n - 15, 16):
+                services.append(_uuid128_str(mv[j:j+16]))
+    if found & (1 << _AD_NAME):
+        start = _ad_ofs[2 * _AD_NAME]
+        try:
+            name = str(mv[start:start + _ad_ofs[2 * _AD_NAME + 1]], 'utf-8')
+        except UnicodeError:
+            pass
+    return name, services, manufacturer_data
+
+def _uuid16_str(buf, j):
+    """Format the 16-bit UUID at buf[j] as 0xXXXX"""
+    return "0x{:04X}".format(buf[j] | (buf[j + 1] << 8))  # little-endian on air
+
+# Byte indices of a little-endian 128-bit UUID in text order; -1 is a dash
+_UUID128_ORDER = (15, 14, 13, 12, -1, 11, 10, -1, 9, 8, -1, 7, 6, -1, 5, 4, 3, 2, 1, 0)
+
+def _uuid128_str(uuid_bytes):
+    """Format a little-endian 128-bit UUID as xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx"""
+    # MicroPython can't slice bytes with step -1, so hexlify the bytes in
+    # wire order and reorder the two-character pairs of the hex string
+    h = binascii.hexlify(uuid_bytes).decode()
+    return "".join(["-" if k < 0 else h[2 * k:2 * k + 2] for k in _UUID128_ORDER])
+
+def _insort(a, x):
+    """Insert x into sorted list a, after any equal items (bisect.insort)"""
+    lo, hi = 0, len(a)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if x < a[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    a.insert(lo, x)
 
 class ESP32BLEScanner:
     def __init__(self):
-        self.devices_found = {}
+        # Devices are stored as parallel arrays indexed by discovery order
+        self._macs = bytearray(6 * _MAX_DEVICES)
+        self._rssi = array.array('b', [0] * _MAX_DEVICES)
+        self._flags = bytearray(_MAX_DEVICES)  # bit 0: random addr, bits 1-3: adv_type
+        self._names = []
+        self._services = []
+        self._mfg = []
+        self._count = 0
+        # (-rssi, idx) for every device, kept sorted strongest first
+        self._order = []
+        # _irq copies raw advertisements into this preallocated ring and
+        # _drain_queue decodes them; the ring is empty when read == write
+        self._seen = set()
+        self._adv_pool = [bytearray(_ADV_MAX) for _ in range(_ADV_SLOTS)]
+        self._adv_lens = array.array('B', [0] * _ADV_SLOTS)
+        self._adv_addrs = bytearray(6 * _ADV_SLOTS)
+        self._adv_rssi = array.array('b', [0] * _ADV_SLOTS)
+        self._adv_flags = bytearray(_ADV_SLOTS)  # same layout as _flags
+        self._adv_write = 0
+        self._adv_read = 0
         self.ble = bluetooth.BLE()
         self.scan_complete = False
 
@@ -24,123 +181,92 @@ class ESP32BLEScanner:
                 self.led = None
                 print("Note: No LED pin available")
 
+    @micropython.native
     def _irq(self, event, data):
         """BLE interrupt handler"""
-        # Use numeric constants instead of named constants
-        # 5 = IRQ_SCAN_RESULT, 6 = IRQ_SCAN_DONE
-        if event == 5:  # IRQ_SCAN_RESULT
+        if event == _IRQ_SCAN_RESULT:
             # data: (addr_type, addr, adv_type, rssi, adv_data)
-            addr_type, addr, adv_type, rssi, adv_data = data
-
-            # Convert address to string
-            mac_addr = ':'.join(['{:02X}'.format(b) for b in addr])
-
-            if mac_addr not in self.devices_found:
-                # Parse advertisement data
-                name = self._decode_name(adv_data) or "Unknown"
-                services = self._decode_services(adv_data)
-                manufacturer_data = self._decode_manufacturer(adv_data)
-
-                addr_type_str = "Public" if addr_type == 0 else "Random"
-
-                self.devices_found[mac_addr] = {
-                    'name': name,
-                    'rssi': rssi,
-                    'addr_type': addr_type_str,
-                    'connectable': adv_type in (0, 1),  # ADV_IND or ADV_DIRECT_IND
-                    'services': services,
-                    'manufacturer_data': manufacturer_data,
-                    'adv_type': adv_type
-                }
-
-                print("*", end="")
-
-                # Show strong signals immediately
-                if rssi > -60:
-                    print(f"\n  Strong: {name} ({mac_addr}) {rssi}dBm", end="")
-
-        elif event == 6:  # IRQ_SCAN_DONE
+            # Most results repeat a device we already have, so check the
+            # raw address before touching anything else
+            key = bytes(data[1])
+            if key in self._seen:
+                return
+            w = self._adv_write
+            if (w + 1) & (_ADV_SLOTS - 1) == self._adv_read:
+                return  # Ring full; device stays unseen so a later advert retries
+            self._seen.add(key)
+
+            addr_type, _, adv_type, rssi, adv_data = data
+            # adv_data is only valid for the duration of the callback
+            n = len(adv_data)
+            if n > _ADV_MAX:
+                n = _ADV_MAX
+                adv_data = adv_data[:n]
+            self._adv_pool[w][:n] = adv_data
+            self._adv_lens[w] = n
+            self._adv_addrs[6 * w:6 * w + 6] = key
+            self._adv_rssi[w] = rssi
+            self._adv_flags[w] = (adv_type << 1) | (1 if addr_type else 0)
+            self._adv_write = (w + 1) & (_ADV_SLOTS - 1)
+
+        elif event == _IRQ_SCAN_DONE:
             self.scan_complete = True
 
-    def _decode_name(self, adv_data):
-        """Decode device name from advertisement data"""
-        try:
-            i = 0
-            while i < len(adv_data):
-                length = adv_data[i]
-                if length == 0:
-                    break
-
-                ad_type = adv_data[i + 1]
-                if ad_type == 0x09:  # Complete Local Name
-                    return adv_data[i + 2:i + 1 + length].decode('utf-8')
-                elif ad_type == 0x08:  # Shortened Local Name
-                    return adv_data[i + 2:i + 1 + length].decode('utf-8')
-
-                i += 1 + length
-        except:
-            pass
-        return None
-
-    def _decode_services(self, adv_data):
-        """Decode services from advertisement data"""
-        services = []
-        try:
-            i = 0
-            while i < len(adv_data):
-                length = adv_data[i]
-                if length == 0:
-                    break
-
-                ad_type = adv_data[i + 1]
-                if ad_type in (0x02, 0x03):  # Incomplete/Complete list of 16-bit UUIDs
-                    for j in range(i + 2, i + 1 + length, 2):
-                        if j + 1 < len(adv_data):
-                            uuid = struct.unpack('<H', adv_data[j:j+2])[0]
-                            services.append(f"0x{uuid:04X}")
-                elif ad_type in (0x06, 0x07):  # Incomplete/Complete list of 128-bit UUIDs
-                    for j in range(i + 2, i + 1 + length, 16):
-                        if j + 15 < len(adv_data):
-                            uuid_bytes = adv_data[j:j+16]
-                            # Convert to standard UUID string format
-                            uuid_str = '-'.join([
-                                uuid_bytes[12:16][::-1].hex(),
-                                uuid_bytes[10:12][::-1].hex(),
-                                uuid_bytes[8:10][::-1].hex(),
-                                uuid_bytes[6:8][::-1].hex(),
-                                uuid_bytes[0:6][::-1].hex()
-                            ])
-                            services.append(uuid_str)
-
-                i += 1 + length
-        except:
-            pass
-        return services
-
-    def _decode_manufacturer(self, adv_data):
-        """Decode manufacturer data from advertisement data"""
-        try:
-            i = 0
-            while i < len(adv_data):
-                length = adv_data[i]
-                if length == 0:
-                    break
-
-                ad_type = adv_data[i + 1]
-                if ad_type == 0xFF:  # Manufacturer Specific Data
-                    return adv_data[i + 2:i + 1 + length]
-
-                i += 1 + length
-        except:
-            pass
-        return None
+    @micropython.native
+    def _drain_queue(self):
+        """Decode advertisements queued by _irq"""
+        r = self._adv_read
+        while r != self._adv_write:
+            slot = r
+            r = (r + 1) & (_ADV_SLOTS - 1)
+            try:
+                # _irq only queues addresses it hasn't seen, so every slot
+                # is a new device
+                if self._count < _MAX_DEVICES:
+                    self._record(slot)
+            finally:
+                # Hand the slot back to _irq only once it has been consumed,
+                # even if decoding it failed, so the ring can't stall
+                self._adv_read = r
+
+    @micropython.native
+    def _record(self, slot):
+        """Decode a ring slot and store it as the next device"""
+        # Parse advertisement data before recording anything, so a
+        # failed decode can't leave the parallel arrays out of step
+        name, services, manufacturer_data = _parse_adv(
+            self._adv_pool[slot], self._adv_lens[slot])
+        name = name or "Unknown"
+
+        idx = self._count
+        rssi = self._adv_rssi[slot]
+        self._macs[6 * idx:6 * idx + 6] = self._adv_addrs[6 * slot:6 * slot + 6]
+        self._rssi[idx] = rssi
+        self._flags[idx] = self._adv_flags[slot]
+        self._names.append(name)
+        self._services.append(services)
+        self._mfg.append(manufacturer_data)
+        _insort(self._order, (-rssi, idx))
+        self._count = idx + 1
+
+        print("*", end="")
+
+        # Show strong signals immediately
+        if rssi > -60:
+            print(f"\n  Strong: {name} ({self._mac(idx)}) {rssi}dBm", end="")
 
     async def scan_devices(self, duration_seconds=15):
         """Scan for BLE devices"""
         print(f"Scanning for BLE devices ({duration_seconds} seconds)...")
         print("=" * 50)
 
-        self.devices_found.clear()
+        self._count = 0
+        self._order.clear()
+        self._names.clear()
+        self._services.clear()
+        self._mfg.clear()
+        self._seen.clear()
+        self._adv_read = self._adv_write
         self.scan_complete = False
 
         if self.led:
@@ -158,19 +284,24 @@ class ESP32BLEScanner:
             # Start scanning
             self.ble.gap_scan(duration_seconds * 1000, 30000, 30000)  # duration, interval, window in microseconds
 
-            # Wait for scan to complete
-            start_time = time.ticks_ms()
+            # Wait for scan to complete, decoding results as they arrive
+            ticks_ms = time.ticks_ms
+            ticks_diff = time.ticks_diff
+            sleep_ms = asyncio.sleep_ms
+            drain = self._drain_queue
+            deadline = time.ticks_add(ticks_ms(), (duration_seconds + 2) * 1000)
             while not self.scan_complete:
-                if time.ticks_diff(time.ticks_ms(), start_time) > (duration_seconds + 2) * 1000:
+                if ticks_diff(deadline, ticks_ms()) <= 0:
                     print("\nScan timeout!")
                     break
-                await asyncio.sleep_ms(100)
+                drain()
+                await sleep_ms(20)
+            drain()
 
-            print(f"\n\nScan complete! Found {len(self.devices_found)} unique devices")
+            print(f"\n\nScan complete! Found {self._count} unique devices")
 
         except Exception as e:
             print(f"\nScan error: {e}")
-            import sys
             sys.print_exception(e)
         finally:
             if self.led:
@@ -180,11 +311,15 @@ class ESP32BLEScanner:
             except:
                 pass
 
-        return self.devices_found
+        return self._count
+
+    def _mac(self, idx):
+        """Format the stored address of device idx as AA:BB:CC:DD:EE:FF"""
+        return binascii.hexlify(self._macs[6 * idx:6 * idx + 6], ':').decode().upper()
 
     def print_results(self):
         """Print detailed scan results"""
-        if not self.devices_found:
+        if not self._count:
             print("No devices found")
             return
 
@@ -192,67 +327,62 @@ class ESP32BLEScanner:
         print("DISCOVERED BLE DEVICES")
         print("=" * 60)
 
-        # Sort by signal strength (strongest first)
-        sorted_devices = sorted(
-            self.devices_found.items(),
-            key=lambda x: x[1]['rssi'],
-            reverse=True
-        )
-
-        for i, (mac, info) in enumerate(sorted_devices, 1):
-            # Signal strength indicator
-            if info['rssi'] > -50:
-                strength = "Excellent"
-            elif info['rssi'] > -60:
-                strength = "Good"
-            elif info['rssi'] > -70:
-                strength = "Fair"
-            elif info['rssi'] > -80:
-                strength = "Weak"
-            else:
-                strength = "Very Weak"
-
-            print(f"\n{i}. {info['name']}")
-            print(f"   MAC Address: {mac}")
-            print(f"   Signal: {info['rssi']} dBm ({strength})")
-            print(f"   Address Type: {info['addr_type']}")
-            print(f"   Connectable: {'Yes' if info['connectable'] else 'No'}")
+        # Devices are kept sorted by signal strength (strongest first)
+        for i, (_, idx) in enumerate(self._order, 1):
+            rssi = self._rssi[idx]
+            flags = self._flags[idx]
+
+            # Signal strength indicator, one 10 dB band per table entry
+            band = (-rssi - 40) // 10
+            strength = _STRENGTH_TABLE[0 if band < 0 else (4 if band > 4 else band)]
+
+            # Build each device's block and write it out in one go
+            out = [
+                f"\n{i}. {self._names[idx]}",
+                f"   MAC Address: {self._mac(idx)}",
+                f"   Signal: {rssi} dBm ({strength})",
+                f"   Address Type: {'Random' if flags & 1 else 'Public'}",
+                # ADV_IND or ADV_DIRECT_IND
+                f"   Connectable: {'Yes' if (flags >> 1) in (0, 1) else 'No'}",
+            ]
 
             # Show services if any
-            if info['services']:
-                service_list = info['services'][:3]  # First 3
-                print(f"   Services: {', '.join(service_list)}")
-                if len(info['services']) > 3:
-                    print(f"   ... and {len(info['services']) - 3} more services")
+            services = self._services[idx]
+            if services:
+                service_list = services[:3]  # First 3
+                out.append(f"   Services: {', '.join(service_list)}")
+                if len(services) > 3:
+                    out.append(f"   ... and {len(services) - 3} more services")
 
             # Show manufacturer data if available
-            if info['manufacturer_data']:
-                mfg_data = info['manufacturer_data']
+            mfg_data = self._mfg[idx]
+            if mfg_data:
                 if len(mfg_data) >= 2:
-                    company_id = struct.unpack('<H', mfg_data[:2])[0]
-                    print(f"   Manufacturer: Company ID 0x{company_id:04X}")
+                    company_id = mfg_data[0] | (mfg_data[1] << 8)
+                    out.append(f"   Manufacturer: Company ID 0x{company_id:04X}")
                 else:
-                    print(f"   Manufacturer: {len(mfg_data)} bytes of data")
+                    out.append(f"   Manufacturer: {len(mfg_data)} bytes of data")
+
+            out.append("")
+            sys.stdout.write("\n".join(out))
 
     def print_summary(self):
         """Print a quick summary"""
-        if not self.devices_found:
+        if not self._count:
             print("No devices found")
             return
 
-        print(f"\nQuick Summary - {len(self.devices_found)} devices:")
+        out = [f"\nQuick Summary - {self._count} devices:"]
 
-        # Sort by signal strength
-        sorted_devices = sorted(
-            self.devices_found.items(),
-            key=lambda x: x[1]['rssi'],
-            reverse=True
-        )
+        for _, idx in self._order:
+            rssi = self._rssi[idx]
+            strength = "Strong" if rssi > -60 else "Weak"
+            name = self._names[idx]
+            name_display = name if name != "Unknown" else "Unnamed"
+            out.append(f"  {name_display} ({self._mac(idx)}) - {rssi}dBm ({strength})")
 
-        for mac, info in sorted_devices:
-            strength = "Strong" if info['rssi'] > -60 else "Weak"
-            name_display = info['name'] if info['name'] != "Unknown" else "Unnamed"
-            print(f"  {name_display} ({mac}) - {info['rssi']}dBm ({strength})")
+        out.append("")
+        sys.stdout.write("\n".join(out))
 
 # Scan functions
 async def quick_scan():
@@ -288,6 +418,29 @@ async def continuous_scan():
     except KeyboardInterrupt:
         print("\nStopped continuous scanning")
 
+async def ainput(prompt=""):
+    """input() that yields to the event loop while waiting for keys"""
+    sys.stdout.write(prompt)
+    poller = select.poll()
+    poller.register(sys.stdin, select.POLLIN)
+    chars = []
+    while True:
+        if not poller.poll(0):
+            await asyncio.sleep_ms(50)
+            continue
+        ch = sys.stdin.read(1)
+        if not ch or ch in "\r\n":
+            break
+        if ch in "\x08\x7f":  # Backspace/Delete
+            if chars:
+                chars.pop()
+                sys.stdout.write("\x08 \x08")
+            continue
+        chars.append(ch)
+        sys.stdout.write(ch)  # stdin isn't echoed outside the REPL
+    sys.stdout.write("\n")
+    return "".join(chars)
+
 async def main():
     """Main function"""
     print("ESP32-C6 BLE Scanner (Low-level)")
@@ -300,7 +453,7 @@ async def main():
     print("4. Continuous scanning")
 
     try:
-        choice = input("Choose (1-4): ").strip()
+        choice = (await ainput("Choose (1-4): ")).strip()
 
         if choice == "1":
             await quick_scan()
@@ -316,7 +469,6 @@ async def main():
 
     except Exception as e:
         print(f"Error: {e}")
-        import sys
         sys.print_exception(e)
 
 def run():